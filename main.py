@@ -1,16 +1,30 @@
 import os
+import re
+import hmac
 import time
+import queue
 import asyncio
-from typing import Optional
-from urllib.parse import urljoin
+import contextlib
+import logging
+import logging.handlers
+from types import MappingProxyType
+from typing import Awaitable, Callable, Mapping, Optional
 
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, Query
 from fastapi import Security
 from fastapi.security.api_key import APIKeyHeader
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.middleware.gzip import GZipMiddleware
 import httpx
+import orjson
+
+try:
+    import fcntl
+except ImportError:  # Windows : pas de flock, le partage du token entre workers est indisponible
+    fcntl = None
 
 from models import (
     OffersStatelessRequest,
@@ -39,100 +53,475 @@ READ_TIMEOUT = float(os.environ.get("READ_TIMEOUT", "60"))
 WRITE_TIMEOUT = float(os.environ.get("WRITE_TIMEOUT", "30"))
 POOL_TIMEOUT = float(os.environ.get("POOL_TIMEOUT", "10"))
 REFRESH_SAFETY = int(os.environ.get("REFRESH_SAFETY", "15"))
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+STALE_SECONDS = int(os.environ.get("STALE_SECONDS", "60"))
+TOKEN_TTL = 300  # on considère ~5 min, l’API ne renvoie pas de TTL
+# Fichier partagé entre workers uvicorn (vide = token propre à chaque process)
+TOKEN_CACHE_FILE = os.environ.get("TOKEN_CACHE_FILE", "")
+TOKEN_LOCK_WAIT = float(os.environ.get("TOKEN_LOCK_WAIT", "5"))
+if TOKEN_CACHE_FILE and fcntl is None:
+    raise RuntimeError("TOKEN_CACHE_FILE nécessite fcntl (non disponible sur cette plateforme)")
+BOMI_CACHE_TTL = float(os.environ.get("BOMI_CACHE_TTL", "120"))
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", "512"))
+HTTPX_MAX_CONN = int(os.environ.get("HTTPX_MAX_CONN", "200"))
+HTTPX_MAX_KA = int(os.environ.get("HTTPX_MAX_KA", "50"))
+HTTPX_KA_EXPIRY = float(os.environ.get("HTTPX_KA_EXPIRY", "15"))
+UPSTREAM_MAX_INFLIGHT = int(os.environ.get("UPSTREAM_MAX_INFLIGHT", "128"))
+UPSTREAM_QUEUE_TIMEOUT = float(os.environ.get("UPSTREAM_QUEUE_TIMEOUT", "0.25"))
+
+MAX_BODY_BYTES = int(os.environ.get("MAX_BODY_BYTES", str(1024 * 1024)))
+CORS_ORIGINS = [o.strip() for o in os.environ.get("CORS_ORIGINS", "").split(",") if o.strip()]
+CORS_ORIGIN_REGEX = os.environ.get("CORS_ORIGIN_REGEX") or None
 
 X_API_KEY = os.environ.get("X_API_KEY", "05f774437a334fe449c223ea1f8db74cea0f3b6a138364d02cad1b950cb74219")  # <-- ta clé API côté serveur
 
 API_BASE = f"{CANAL_BASE}/api/rest/onlinesales/v1"
+
+# URLs upstream figées au chargement du module
+URL_AUTH = f"{CANAL_BASE}{CANAL_AUTH_PATH}"
+CGA_BASE = f"{API_BASE}/cgaOnlineSales"
+URL_DISTRIBUTORS = f"{CGA_BASE}/getDistributors"
+URL_SUBSCRIBERS = f"{CGA_BASE}/getSubscribers"
+URL_COUNTRIES = f"{CGA_BASE}/getCountries"
+URL_ELIGIBILITY_APPOINTMENT = f"{CGA_BASE}/eligibilityAppointment"
+URL_CAN_BE_RENEWED = f"{CGA_BASE}/canBeRenewed"
+URL_GROUP_BROADCASTING_WAYS = f"{CGA_BASE}/getGroupBroadcastingWays"
+URL_DURATIONS = f"{CGA_BASE}/getDurations"
+URL_PAYMENT_METHODS = f"{CGA_BASE}/getPaymentMethods"
+URL_OFFERS_STATELESS = f"{CGA_BASE}/getAvailableOffersStateless"
+URL_OPTIONS_STATELESS = f"{CGA_BASE}/getAvailableOptionsStateless"
+URL_BASKET_STATELESS = f"{CGA_BASE}/getBasketStateless"
+URL_REGISTER_QUICK_RENEWAL = f"{CGA_BASE}/registerQuickRenewal"
+URL_BOMI_PAYMENT_MEANS = f"{BOMI_BASE}/api/v1/paymentMeans"
+# Paramètres BOMI par défaut du flow /recharge (constants, partagés en lecture seule)
+BOMI_QUICK_PARAMS = MappingProxyType({
+    "countryId": COUNTRY_ID,
+    "managementAct": "RENEWAL_QUICK",
+    "saleDeviceId": SALE_DEVICE_ID,
+    "distributorId": DISTRIBUTOR_ID,
+})
+# Endpoints paramétrés : str.format déjà lié, appelé avec les segments dynamiques
+URL_CREDIT_PDV_TMPL = (URL_DISTRIBUTORS + "/{}/creditPDV").format
+URL_RIGHTS_TMPL = (URL_DISTRIBUTORS + "/{}/rights").format
+URL_SOLDE_TMPL = (CGA_BASE + "/getSoldeSubscriber/{}/{}").format
+URL_REACTIVATE_TMPL = (CGA_BASE + "/isPossibleToReactivate/{}/{}").format
+URL_COUPONS_TMPL = (CGA_BASE + "/getAvailableCoupons/{}/{}").format
+
+# reportUrl : chemin relatif ou URL absolue sur CANAL_BASE uniquement (pas d'autre hôte -> pas de SSRF)
+_REPORT_RE = re.compile(rf"^(?:{re.escape(CANAL_BASE)}/|/?(?![A-Za-z][\w+.-]*:|/))[^#]*reports/")
+_FN_RE = re.compile(rb'filename="?([^";]+)')
+
 DEFAULT_TIMEOUT = httpx.Timeout(
     connect=CONNECT_TIMEOUT, read=READ_TIMEOUT, write=WRITE_TIMEOUT, pool=POOL_TIMEOUT
 )
+DEFAULT_LIMITS = httpx.Limits(
+    max_connections=HTTPX_MAX_CONN, max_keepalive_connections=HTTPX_MAX_KA, keepalive_expiry=HTTPX_KA_EXPIRY
+)
 BASE_HEADERS = {"Accept": "application/json"}
+JSON_HEADERS = {"Content-Type": "application/json"}
+# Corps et en-têtes du login sérialisés une fois pour toutes
+AUTH_BODY = orjson.dumps({"userName": CANAL_USER, "password": CANAL_PASS})
+AUTH_HEADERS = {**BASE_HEADERS, **JSON_HEADERS}
+
+# ================== LOGS ==================
+# Les handlers écrivent depuis le thread du QueueListener : pas d'I/O stdout dans la boucle asyncio
+log = logging.getLogger("gateway")
+log.setLevel(LOG_LEVEL)
+log.propagate = False
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
 
 # ================== SÉCURITÉ (X-API-Key) ==================
 # Déclare un schéma d’API key pour que Swagger affiche le bouton Authorize
 api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
 
+_X_API_KEY_B = X_API_KEY.encode()
+
 def get_api_key(api_key: str = Security(api_key_header)) -> str:
-    if not X_API_KEY or api_key != X_API_KEY:
+    # comparaison à temps constant : pas de fuite de préfixe par le timing
+    if not X_API_KEY or not api_key or not hmac.compare_digest(api_key.encode(), _X_API_KEY_B):
         raise HTTPException(status_code=401, detail="Invalid or missing X-API-Key")
     return api_key
 
+API_KEY_DEP = Security(get_api_key)
+
 # ================== SESSION CANAL ==================
+# Back-pressure : au-delà de UPSTREAM_MAX_INFLIGHT appels upstream, on attend peu puis 503
+_upstream_sem = asyncio.Semaphore(UPSTREAM_MAX_INFLIGHT)
+
+@contextlib.asynccontextmanager
+async def upstream_slot():
+    try:
+        await asyncio.wait_for(_upstream_sem.acquire(), timeout=UPSTREAM_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="Upstream saturé, réessayez")
+    try:
+        yield
+    finally:
+        _upstream_sem.release()
+
+# Token partagé entre workers : {"token", "exp"} (exp en temps mural), écrit de façon atomique
+def _read_shared_token() -> Optional[tuple[str, float]]:
+    try:
+        with open(TOKEN_CACHE_FILE, "rb") as f:
+            data = orjson.loads(f.read())
+        return data["token"], float(data["exp"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def _write_shared_token(token: str, exp: float) -> None:
+    tmp = f"{TOKEN_CACHE_FILE}.{os.getpid()}.tmp"
+    try:
+        # créé directement en 0600 (O_EXCL : un ancien tmp aux droits plus larges n'est pas réutilisé)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with open(fd, "wb") as f:
+            f.write(orjson.dumps({"token": token, "exp": exp}))
+        os.replace(tmp, TOKEN_CACHE_FILE)
+    except OSError as e:
+        log.warning("token cache write failed: %s", e)
+
+async def _lock_token_file() -> Optional[int]:
+    """Verrou inter-process non bloquant pour la boucle ; None si indisponible (login local)."""
+    try:
+        fd = os.open(f"{TOKEN_CACHE_FILE}.lock", os.O_CREAT | os.O_RDWR, 0o600)
+    except OSError as e:
+        log.warning("token lock unavailable: %s", e)
+        return None
+    deadline = time.monotonic() + TOKEN_LOCK_WAIT
+    while True:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                os.close(fd)
+                return None
+        except BaseException:
+            os.close(fd)
+            raise
+        try:
+            await asyncio.sleep(0.05)
+        except BaseException:
+            os.close(fd)
+            raise
+
 class CanalSession:
     def __init__(self):
         self._token: Optional[str] = None
         self._exp: float = 0.0
+        self._stale: float = 0.0
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._auth_headers: Mapping[str, str] = MappingProxyType(BASE_HEADERS)
+        self._inflight: dict[tuple, asyncio.Task] = {}
+        self._lock = asyncio.Lock()
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def start(self) -> None:
+        """Ouvre le client pour un cycle de vie de l'app (rappelable après aclose())."""
+        self._client = httpx.AsyncClient(http2=True, timeout=DEFAULT_TIMEOUT, limits=DEFAULT_LIMITS)
+        # primitives asyncio liées à la boucle courante
         self._lock = asyncio.Lock()
-        self._client = httpx.AsyncClient(timeout=DEFAULT_TIMEOUT)
+        self._inflight = {}
+        self._refresh_task = None
 
     async def login(self) -> None:
-        url = f"{CANAL_BASE}{CANAL_AUTH_PATH}"
-        payload = {"userName": CANAL_USER, "password": CANAL_PASS}
-        r = await self._client.post(
-            url, json=payload, headers={**BASE_HEADERS, "Content-Type": "application/json"}
-        )
-        print(f"[AUTH] status={r.status_code} url={url}")
+        url = URL_AUTH
+        r = await self._client.post(url, content=AUTH_BODY, headers=AUTH_HEADERS)
+        log.debug("auth status=%s url=%s http=%s", r.status_code, url, r.http_version)
         if r.status_code != 200:
             raise HTTPException(status_code=502, detail=f"Auth failed ({r.status_code})")
 
-        data = r.json()
+        data = orjson.loads(r.content)
         token = data.get("token")
         if not token:
             raise HTTPException(status_code=502, detail="Auth: 'token' introuvable dans la réponse")
 
-        ttl = 300  # on considère ~5 min, l’API ne renvoie pas de TTL
-        now = time.time()
+        self._set_token(token, TOKEN_TTL)
+        if TOKEN_CACHE_FILE:
+            _write_shared_token(token, time.time() + TOKEN_TTL)
+        log.info("auth token cached, expires in ~%ss", TOKEN_TTL - REFRESH_SAFETY)
+
+    def _set_token(self, token: str, ttl: float) -> None:
+        now = time.monotonic()
         self._token = token
+        # en-têtes figés pour cette génération de token (réutilisés tels quels par req/stream)
+        self._auth_headers = MappingProxyType({**BASE_HEADERS, "Authorization": f"Bearer {token}"})
         self._exp = now + ttl - REFRESH_SAFETY
-        print(f"[AUTH] token cached. Expire dans ~{ttl - REFRESH_SAFETY}s")
+        # jamais au-delà de _exp : sinon le chemin sans verrou servirait un token expiré (STALE_SECONDS < REFRESH_SAFETY)
+        self._stale = min(now + ttl - STALE_SECONDS, self._exp)
+
+    async def _refresh(self) -> None:
+        """Renouvelle le token ; avec TOKEN_CACHE_FILE, un seul worker fait le login."""
+        if not TOKEN_CACHE_FILE:
+            await self.login()
+            return
+        fd = await _lock_token_file()
+        try:
+            # un autre worker a pu se connecter pendant qu'on attendait le verrou
+            shared = _read_shared_token()
+            if shared and shared[0] != self._token:
+                remaining = shared[1] - time.time()
+                # doit rester frais après la marge REFRESH_SAFETY, sinon on le réadopterait en boucle
+                if remaining > max(STALE_SECONDS, REFRESH_SAFETY):
+                    self._set_token(shared[0], remaining)
+                    log.info("auth token adopted from %s", TOKEN_CACHE_FILE)
+                    return
+            await self.login()
+        finally:
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+    async def _background_login(self) -> None:
+        try:
+            async with self._lock:
+                if time.monotonic() >= self._stale:
+                    await self._refresh()
+        except Exception as e:
+            log.warning("auth background refresh failed: %s", e)
 
     async def ensure_token(self) -> str:
+        now = time.monotonic()
+        # FRESH : pas de verrou
+        if self._token and now < self._stale:
+            return self._token
+        # STALE : on rafraîchit en tâche de fond et on sert le token courant
+        if self._token and now < self._exp:
+            # référence gardée : la boucle ne tient qu'une weakref sur les tâches
+            if self._refresh_task is None or self._refresh_task.done():
+                self._refresh_task = asyncio.create_task(self._background_login())
+            return self._token
+        # EXPIRED : bloquant
+        async with self._lock:
+            if not self._token or time.monotonic() >= self._exp:
+                await self._refresh()
+            return self._token
+
+    async def _relogin(self, rejected: str) -> str:
         async with self._lock:
-            if not self._token or time.time() >= self._exp:
-                await self.login()
+            # un seul login pour une rafale de 401 : les suivants récupèrent le nouveau token
+            if self._token == rejected:
+                await self._refresh()
             return self._token
 
     async def req(self, method: str, url: str, **kwargs) -> httpx.Response:
+        # GET identiques simultanés : une seule requête upstream, réponse (déjà lue) partagée
+        if method != "GET" or kwargs.get("headers"):
+            return await self._request(method, url, **kwargs)
+        params = kwargs.get("params")
+        if not params:
+            pkey = None
+        elif isinstance(params, Mapping):
+            pkey = frozenset(params.items())
+        else:
+            pkey = tuple(params)
+        key = (url, pkey)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._request(method, url, **kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield : l'annulation d'un appelant n'annule pas la requête partagée
+        return await asyncio.shield(task)
+
+    def _headers(self, extra: Optional[dict]) -> Mapping[str, str]:
+        return self._auth_headers if not extra else {**self._auth_headers, **extra}
+
+    async def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        extra = kwargs.pop("headers", None)
         token = await self.ensure_token()
-        headers = kwargs.pop("headers", {})
-        headers = {**BASE_HEADERS, **headers, "Authorization": f"Bearer {token}"}
-        r = await self._client.request(method, url, headers=headers, **kwargs)
-        if r.status_code == 401:
-            async with self._lock:
-                await self.login()
-                headers["Authorization"] = f"Bearer {self._token}"
+        headers = self._headers(extra)
+        async with upstream_slot():
             r = await self._client.request(method, url, headers=headers, **kwargs)
+        if r.status_code == 401:
+            await self._relogin(token)
+            headers = self._headers(extra)
+            async with upstream_slot():
+                r = await self._client.request(method, url, headers=headers, **kwargs)
+        return r
+
+    async def stream(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Comme req(), mais sans lire le corps : l'appelant doit fermer la réponse (aclose)."""
+        extra = kwargs.pop("headers", None)
+        token = await self.ensure_token()
+        headers = self._headers(extra)
+        request = self._client.build_request(method, url, headers=headers, **kwargs)
+        # le slot couvre l'ouverture (jusqu'aux en-têtes), pas le relais du corps
+        async with upstream_slot():
+            r = await self._client.send(request, stream=True)
+        if r.status_code == 401:
+            await r.aclose()
+            await self._relogin(token)
+            headers = self._headers(extra)
+            request = self._client.build_request(method, url, headers=headers, **kwargs)
+            async with upstream_slot():
+                r = await self._client.send(request, stream=True)
         return r
 
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
 auth = CanalSession()
 
+# Client BOMI partagé : connexions keep-alive réutilisées entre les appels (ouvert au startup)
+bomi_client: Optional[httpx.AsyncClient] = None
+
 # ================== APP ==================
-app = FastAPI(title="RSINC Canal+ Gateway", version="1.2.0")
+app = FastAPI(title="RSINC Canal+ Gateway", version="1.2.0", default_response_class=ORJSONResponse)
+
+class BodySizeLimit:
+    """Rejette (413) les requêtes dont le Content-Length annoncé dépasse MAX_BODY_BYTES, avant lecture du corps."""
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            for k, v in scope["headers"]:
+                if k == b"content-length":
+                    if not v.isdigit() or int(v) > self.max_bytes:
+                        resp = ORJSONResponse(
+                            status_code=413, content={"detail": "Corps de requête trop volumineux"}
+                        )
+                        await resp(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
+class GZipExceptDownloads:
+    """GZip pour les réponses JSON ; les téléchargements (PDF déjà compressés, streamés) passent tels quels."""
+
+    def __init__(self, app, minimum_size: int, compresslevel: int):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size, compresslevel=compresslevel)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] != "/report/download":
+            await self.gzip(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+app.add_middleware(GZipExceptDownloads, minimum_size=1024, compresslevel=5)
+app.add_middleware(BodySizeLimit, max_bytes=MAX_BODY_BYTES)
+# CORS_ORIGINS vide : "*" sans credentials (l'auth passe par X-API-Key, pas par des cookies)
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # ajuste si tu veux restreindre
-    allow_methods=["*"],
-    allow_headers=["*"],
-    allow_credentials=True,
+    allow_origins=CORS_ORIGINS or ["*"],
+    allow_origin_regex=CORS_ORIGIN_REGEX,
+    allow_methods=["GET", "POST"],
+    allow_headers=["X-API-Key", "Content-Type", "Accept"],
+    allow_credentials=bool(CORS_ORIGINS),
+    max_age=86400,
 )
 
-def _to_json_response(r: httpx.Response) -> JSONResponse:
+def _passthrough(r: httpx.Response) -> Response:
+    # Pas de transformation : on renvoie les octets upstream tels quels (ni decode ni re-encode)
+    return Response(
+        content=r.content,
+        status_code=r.status_code,
+        media_type=r.headers.get("Content-Type", "application/json"),
+    )
+
+# ---------- Cache TTL (GET idempotents) ----------
+# Les réponses httpx sont déjà lues : on peut les garder telles quelles et les resservir.
+# Clé structurée (url, paires triées) : aucune concaténation ambiguë entre jeux de paramètres
+CacheKey = tuple[str, tuple[tuple[str, str], ...]]
+# entrée = (expire_à, réponse) ; ordre d'insertion du dict = ordre LRU (la plus ancienne en tête)
+_cache: dict[CacheKey, tuple[float, httpx.Response]] = {}
+_cache_locks: dict[CacheKey, asyncio.Lock] = {}
+
+def _cache_key(url: str, params: Optional[Mapping[str, str]] = None) -> CacheKey:
+    return (url, tuple(sorted(params.items())) if params else ())
+
+def _cache_store(key: CacheKey, ttl: float, r: httpx.Response) -> None:
+    _cache.pop(key, None)
+    if len(_cache) >= CACHE_MAX_ENTRIES:
+        # les clés viennent des query params clients : on purge les expirées, puis les plus anciennes
+        now = time.time()
+        for k in [k for k, (exp, _) in _cache.items() if exp <= now]:
+            del _cache[k]
+        while len(_cache) >= CACHE_MAX_ENTRIES:
+            del _cache[next(iter(_cache))]
+    _cache[key] = (time.time() + ttl, r)
+
+async def cached_fetch(
+    key: CacheKey, ttl: float, fetch: Callable[[Optional[dict]], Awaitable[httpx.Response]]
+) -> httpx.Response:
+    """fetch(headers) fait l'appel upstream ; headers porte If-None-Match lors d'une revalidation."""
+    entry = _cache.get(key)
+    if entry and time.time() < entry[0]:
+        _cache[key] = _cache.pop(key)  # hit : l'entrée repasse en queue (LRU)
+        return entry[1]
+    lock = _cache_locks.setdefault(key, asyncio.Lock())
     try:
-        return JSONResponse(status_code=r.status_code, content=r.json())
-    except Exception:
-        return JSONResponse(status_code=r.status_code, content={"raw": r.text})
+        async with lock:
+            # un autre appel a pu remplir le cache pendant l'attente du verrou
+            entry = _cache.get(key)
+            if entry and time.time() < entry[0]:
+                return entry[1]
+            etag = entry[1].headers.get("ETag") if entry else None
+            r = await fetch({"If-None-Match": etag} if etag else None)
+            if r.status_code == 304 and entry:
+                # inchangé côté upstream : on prolonge l'entrée sans retélécharger le corps
+                _cache_store(key, ttl, entry[1])
+                return entry[1]
+            if r.status_code == 200:
+                _cache_store(key, ttl, r)
+            return r
+    finally:
+        # les appels déjà en attente gardent leur référence ; les suivants trouvent le cache rempli
+        if _cache_locks.get(key) is lock:
+            del _cache_locks[key]
+
+async def cached_get(
+    key: CacheKey, ttl: float, fetch: Callable[[Optional[dict]], Awaitable[httpx.Response]]
+) -> Response:
+    return _passthrough(await cached_fetch(key, ttl, fetch))
+
+async def bomi_payment_means_cached(params: Mapping[str, str]) -> httpx.Response:
+    url = URL_BOMI_PAYMENT_MEANS
+
+    async def fetch(headers: Optional[dict]) -> httpx.Response:
+        async with upstream_slot():
+            return await bomi_client.get(url, params=params, headers=headers)
+
+    return await cached_fetch(_cache_key(url, params), BOMI_CACHE_TTL, fetch)
+
+_CANAL_ROOT = CANAL_BASE + "/"
 
 def _abs_report_url(report_url: str) -> str:
-    if report_url.startswith("http"):
+    # CANAL_BASE = schéma + hôte (+ éventuel chemin) sans "/" final : une concaténation suffit
+    if report_url.startswith(("http://", "https://")):
         return report_url
-    return urljoin(CANAL_BASE + "/", report_url.lstrip("/"))
+    return _CANAL_ROOT + report_url.lstrip("/")
 
 @app.on_event("startup")
 async def _startup():
+    global bomi_client, _upstream_sem
+    log_listener.start()
+    # clients et sémaphore créés par cycle de vie : un second startup dans le même process repart à neuf
+    _upstream_sem = asyncio.Semaphore(UPSTREAM_MAX_INFLIGHT)
+    bomi_client = httpx.AsyncClient(
+        http2=True, timeout=DEFAULT_TIMEOUT, limits=DEFAULT_LIMITS, headers=BASE_HEADERS
+    )
+    auth.start()
     try:
-        await auth.login()
+        # passe par le cache partagé : les workers démarrés ensemble ne se connectent pas tous
+        await auth.ensure_token()
     except Exception as e:
-        print("[STARTUP] auth deferred:", e)
+        log.warning("startup auth deferred: %s", e)
+
+@app.on_event("shutdown")
+async def _shutdown():
+    await bomi_client.aclose()
+    await auth.aclose()
+    log_listener.stop()
 
 # ----------- PUBLIC ----------
 @app.get("/health")
@@ -146,22 +535,21 @@ async def authenticate():
 
 # ============ Canal+ (lecture) ============
 @app.get("/distributors")
-async def get_distributors(api_key: str = Security(get_api_key)):
-    url = f"{API_BASE}/cgaOnlineSales/getDistributors"
-    r = await auth.req("GET", url)
-    return _to_json_response(r)
+async def get_distributors(api_key: str = API_KEY_DEP):
+    url = URL_DISTRIBUTORS
+    return await cached_get(_cache_key(url), 3600, lambda h: auth.req("GET", url, headers=h))
 
 @app.get("/distributors/{number}/creditPDV")
-async def credit_pdv(number: str, api_key: str = Security(get_api_key)):
-    url = f"{API_BASE}/cgaOnlineSales/getDistributors/{number}/creditPDV"
+async def credit_pdv(number: str, api_key: str = API_KEY_DEP):
+    url = URL_CREDIT_PDV_TMPL(number)
     r = await auth.req("GET", url)
-    return _to_json_response(r)
+    return _passthrough(r)
 
 @app.get("/distributors/{number}/rights")
-async def distributor_rights(number: str, api_key: str = Security(get_api_key)):
-    url = f"{API_BASE}/cgaOnlineSales/getDistributors/{number}/rights"
+async def distributor_rights(number: str, api_key: str = API_KEY_DEP):
+    url = URL_RIGHTS_TMPL(number)
     r = await auth.req("GET", url)
-    return _to_json_response(r)
+    return _passthrough(r)
 
 @app.get("/subscribers")
 async def get_subscribers(
@@ -171,98 +559,104 @@ async def get_subscribers(
     phoneNumber: Optional[str] = None,
     materialNumber: Optional[str] = None,
     email: Optional[str] = None,
-    api_key: str = Security(get_api_key),
+    api_key: str = API_KEY_DEP,
 ):
-    url = f"{API_BASE}/cgaOnlineSales/getSubscribers"
-    params = {
-        "userId": userId, "distributorNumber": distributorNumber,
-        "subscriberNumber": subscriberNumber, "phoneNumber": phoneNumber,
-        "materialNumber": materialNumber, "email": email,
-    }
-    params = {k: v for k, v in params.items() if v not in (None, "")}
+    url = URL_SUBSCRIBERS
+    params = []
+    if userId:
+        params.append(("userId", userId))
+    if distributorNumber:
+        params.append(("distributorNumber", distributorNumber))
+    if subscriberNumber:
+        params.append(("subscriberNumber", subscriberNumber))
+    if phoneNumber:
+        params.append(("phoneNumber", phoneNumber))
+    if materialNumber:
+        params.append(("materialNumber", materialNumber))
+    if email:
+        params.append(("email", email))
     r = await auth.req("GET", url, params=params)
-    return _to_json_response(r)
+    return _passthrough(r)
 
 @app.get("/countries")
-async def get_countries(api_key: str = Security(get_api_key)):
-    url = f"{API_BASE}/cgaOnlineSales/getCountries"
-    r = await auth.req("GET", url)
-    return _to_json_response(r)
+async def get_countries(api_key: str = API_KEY_DEP):
+    url = URL_COUNTRIES
+    return await cached_get(_cache_key(url), 3600, lambda h: auth.req("GET", url, headers=h))
 
 @app.get("/solde-subscriber/{subscriberId}/{cardIndex}")
-async def get_solde_subscriber(subscriberId: str, cardIndex: int, api_key: str = Security(get_api_key)):
-    url = f"{API_BASE}/cgaOnlineSales/getSoldeSubscriber/{subscriberId}/{cardIndex}"
+async def get_solde_subscriber(subscriberId: str, cardIndex: int, api_key: str = API_KEY_DEP):
+    url = URL_SOLDE_TMPL(subscriberId, cardIndex)
     r = await auth.req("GET", url)
-    return _to_json_response(r)
+    return _passthrough(r)
 
 @app.get("/reactivate-possible/{subscriberId}/{cardIndex}")
-async def is_possible_to_reactivate(subscriberId: str, cardIndex: int, api_key: str = Security(get_api_key)):
-    url = f"{API_BASE}/cgaOnlineSales/isPossibleToReactivate/{subscriberId}/{cardIndex}"
+async def is_possible_to_reactivate(subscriberId: str, cardIndex: int, api_key: str = API_KEY_DEP):
+    url = URL_REACTIVATE_TMPL(subscriberId, cardIndex)
     r = await auth.req("GET", url)
-    return _to_json_response(r)
+    return _passthrough(r)
 
 @app.get("/available-coupons/{subscriberId}/{cardIndex}")
-async def get_available_coupons(subscriberId: str, cardIndex: int, api_key: str = Security(get_api_key)):
-    url = f"{API_BASE}/cgaOnlineSales/getAvailableCoupons/{subscriberId}/{cardIndex}"
+async def get_available_coupons(subscriberId: str, cardIndex: int, api_key: str = API_KEY_DEP):
+    url = URL_COUPONS_TMPL(subscriberId, cardIndex)
     r = await auth.req("GET", url)
-    return _to_json_response(r)
+    return _passthrough(r)
 
 @app.get("/eligibility-appointment")
-async def eligibility_appointment(dateToDate: str = Query(...), api_key: str = Security(get_api_key)):
-    url = f"{API_BASE}/cgaOnlineSales/eligibilityAppointment"
+async def eligibility_appointment(dateToDate: str = Query(...), api_key: str = API_KEY_DEP):
+    url = URL_ELIGIBILITY_APPOINTMENT
     r = await auth.req("GET", url, params={"dateToDate": dateToDate})
-    return _to_json_response(r)
+    return _passthrough(r)
 
 @app.get("/can-be-renewed")
 async def can_be_renewed(
     dateToDate: str = Query("dd"),
     distributorNumber: str = Query(...),
-    api_key: str = Security(get_api_key),
+    api_key: str = API_KEY_DEP,
 ):
-    url = f"{API_BASE}/cgaOnlineSales/canBeRenewed"
-    r = await auth.req("GET", url, params={"dateToDate": dateToDate, "distributorNumber": distributorNumber})
-    return _to_json_response(r)
+    url = URL_CAN_BE_RENEWED
+    params = {"dateToDate": dateToDate, "distributorNumber": distributorNumber}
+    return await cached_get(_cache_key(url, params), 60, lambda h: auth.req("GET", url, params=params, headers=h))
 
 @app.get("/group-broadcasting-ways")
-async def get_group_broadcasting_ways(dateToDate: str = Query("dd"), api_key: str = Security(get_api_key)):
-    url = f"{API_BASE}/cgaOnlineSales/getGroupBroadcastingWays"
-    r = await auth.req("GET", url, params={"dateToDate": dateToDate})
-    return _to_json_response(r)
+async def get_group_broadcasting_ways(dateToDate: str = Query("dd"), api_key: str = API_KEY_DEP):
+    url = URL_GROUP_BROADCASTING_WAYS
+    params = {"dateToDate": dateToDate}
+    return await cached_get(_cache_key(url, params), 600, lambda h: auth.req("GET", url, params=params, headers=h))
 
 @app.get("/durations")
 async def get_durations(
     dateToDate: str = Query("dd"),
     distributorNumber: str = Query(...),
-    api_key: str = Security(get_api_key),
+    api_key: str = API_KEY_DEP,
 ):
-    url = f"{API_BASE}/cgaOnlineSales/getDurations"
-    r = await auth.req("GET", url, params={"dateToDate": dateToDate, "distributorNumber": distributorNumber})
-    return _to_json_response(r)
+    url = URL_DURATIONS
+    params = {"dateToDate": dateToDate, "distributorNumber": distributorNumber}
+    return await cached_get(_cache_key(url, params), 600, lambda h: auth.req("GET", url, params=params, headers=h))
 
 @app.get("/payment-methods")
-async def get_payment_methods(dateToDate: str = Query("dd"), api_key: str = Security(get_api_key)):
-    url = f"{API_BASE}/cgaOnlineSales/getPaymentMethods"
-    r = await auth.req("GET", url, params={"dateToDate": dateToDate})
-    return _to_json_response(r)
+async def get_payment_methods(dateToDate: str = Query("dd"), api_key: str = API_KEY_DEP):
+    url = URL_PAYMENT_METHODS
+    params = {"dateToDate": dateToDate}
+    return await cached_get(_cache_key(url, params), 600, lambda h: auth.req("GET", url, params=params, headers=h))
 
 # ---------- Stateless (POST) ----------
 @app.post("/offers/stateless")
-async def get_available_offers_stateless(payload: OffersStatelessRequest, api_key: str = Security(get_api_key)):
-    url = f"{API_BASE}/cgaOnlineSales/getAvailableOffersStateless"
-    r = await auth.req("POST", url, json=payload.model_dump(mode="json"))
-    return _to_json_response(r)
+async def get_available_offers_stateless(payload: OffersStatelessRequest, api_key: str = API_KEY_DEP):
+    url = URL_OFFERS_STATELESS
+    r = await auth.req("POST", url, content=payload.model_dump_json(), headers=JSON_HEADERS)
+    return _passthrough(r)
 
 @app.post("/options/stateless")
-async def get_available_options_stateless(payload: OptionsStatelessRequest, api_key: str = Security(get_api_key)):
-    url = f"{API_BASE}/cgaOnlineSales/getAvailableOptionsStateless"
-    r = await auth.req("POST", url, json=payload.model_dump(mode="json"))
-    return _to_json_response(r)
+async def get_available_options_stateless(payload: OptionsStatelessRequest, api_key: str = API_KEY_DEP):
+    url = URL_OPTIONS_STATELESS
+    r = await auth.req("POST", url, content=payload.model_dump_json(), headers=JSON_HEADERS)
+    return _passthrough(r)
 
 @app.post("/basket/stateless")
-async def get_basket_stateless(payload: BasketStatelessRequest, api_key: str = Security(get_api_key)):
-    url = f"{API_BASE}/cgaOnlineSales/getBasketStateless"
-    r = await auth.req("POST", url, json=payload.model_dump(mode="json"))
-    return _to_json_response(r)
+async def get_basket_stateless(payload: BasketStatelessRequest, api_key: str = API_KEY_DEP):
+    url = URL_BASKET_STATELESS
+    r = await auth.req("POST", url, content=payload.model_dump_json(), headers=JSON_HEADERS)
+    return _passthrough(r)
 
 # ---------- BOMI ----------
 @app.get("/bomi/payment-means")
@@ -271,20 +665,18 @@ async def bomi_payment_means(
     managementAct: str = Query("FLASH_RENEWAL"),
     saleDeviceId: str = Query(SALE_DEVICE_ID),
     distributorId: str = Query(DISTRIBUTOR_ID),
-    api_key: str = Security(get_api_key),
+    api_key: str = API_KEY_DEP,
 ):
     if not BOMI_BASE:
         raise HTTPException(500, "BOMI_BASE non configuré")
-    url = f"{BOMI_BASE}/api/v1/paymentMeans"
     params = {
         "countryId": countryId,
         "managementAct": managementAct,
         "saleDeviceId": saleDeviceId,
         "distributorId": distributorId,
     }
-    async with httpx.AsyncClient(timeout=DEFAULT_TIMEOUT) as client:
-        r = await client.get(url, params=params, headers=BASE_HEADERS)
-    return _to_json_response(r)
+    r = await bomi_payment_means_cached(params)
+    return _passthrough(r)
 
 @app.get("/bomi/payment-means/quick")
 async def bomi_payment_means_quick(
@@ -292,39 +684,57 @@ async def bomi_payment_means_quick(
     managementAct: str = Query("RENEWAL_QUICK"),
     saleDeviceId: str = Query(SALE_DEVICE_ID),
     distributorId: str = Query(DISTRIBUTOR_ID),
-    api_key: str = Security(get_api_key),
+    api_key: str = API_KEY_DEP,
 ):
     if not BOMI_BASE:
         raise HTTPException(500, "BOMI_BASE non configuré")
-    url = f"{BOMI_BASE}/api/v1/paymentMeans"
     params = {
         "countryId": countryId,
         "managementAct": managementAct,
         "saleDeviceId": saleDeviceId,
         "distributorId": distributorId,
     }
-    async with httpx.AsyncClient(timeout=DEFAULT_TIMEOUT) as client:
-        r = await client.get(url, params=params, headers=BASE_HEADERS)
-    return _to_json_response(r)
+    r = await bomi_payment_means_cached(params)
+    return _passthrough(r)
 
 # ---------- Quick renewal direct ----------
 @app.post("/register-quick-renewal")
-async def register_quick_renewal(payload: QuickRenewalRequest, api_key: str = Security(get_api_key)):
-    url = f"{API_BASE}/cgaOnlineSales/registerQuickRenewal"
-    r = await auth.req("POST", url, json=payload.model_dump(mode="json"))
-    return _to_json_response(r)
+async def register_quick_renewal(payload: QuickRenewalRequest, api_key: str = API_KEY_DEP):
+    url = URL_REGISTER_QUICK_RENEWAL
+    r = await auth.req("POST", url, content=payload.model_dump_json(), headers=JSON_HEADERS)
+    return _passthrough(r)
 
 # ---------- Flow complet + lien PDF ----------
 @app.post("/recharge")
-async def recharge_flow(flow: RechargeFlowRequest, api_key: str = Security(get_api_key)):
-    # 1) Basket
-    basket_url = f"{API_BASE}/cgaOnlineSales/getBasketStateless"
-    r_basket = await auth.req("POST", basket_url, json=flow.basket.model_dump(mode="json"))
-    if r_basket.status_code != 200:
-        return _to_json_response(r_basket)
-    basket_json = r_basket.json()
-    if basket_json.get("severity") != "SUCCESS":
-        return JSONResponse(status_code=502, content={"detail": "Panier non SUCCESS", "basket": basket_json})
+async def recharge_flow(flow: RechargeFlowRequest, api_key: str = API_KEY_DEP):
+    # BOMI (info) part tout de suite en tâche de fond : il n'alimente pas registerQuickRenewal
+    bomi_task = None
+    if BOMI_BASE:
+        bomi_task = asyncio.create_task(bomi_payment_means_cached(BOMI_QUICK_PARAMS))
+        # issue toujours lue, même si on abandonne la tâche (sinon "Task exception was never retrieved")
+        bomi_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    # 1) Basket (si échec : on annule BOMI, inutile de le laisser tourner)
+    basket_url = URL_BASKET_STATELESS
+    early = None
+    try:
+        r_basket = await auth.req("POST", basket_url, content=flow.basket.model_dump_json(), headers=JSON_HEADERS)
+        if r_basket.status_code != 200:
+            early = _passthrough(r_basket)
+        else:
+            basket_json = orjson.loads(r_basket.content)
+            if basket_json.get("severity") != "SUCCESS":
+                early = ORJSONResponse(
+                    status_code=502, content={"detail": "Panier non SUCCESS", "basket": basket_json}
+                )
+    except BaseException:
+        if bomi_task:
+            bomi_task.cancel()
+        raise
+    if early is not None:
+        if bomi_task:
+            bomi_task.cancel()
+        return early
 
     basket = basket_json.get("basket") or {}
     first_amount = basket.get("firstAmount")
@@ -332,42 +742,50 @@ async def recharge_flow(flow: RechargeFlowRequest, api_key: str = Security(get_a
     sel_offer = basket.get("selectedOffer") or {}
     offer_code = sel_offer.get("offerCode")
 
-    # 2) BOMI (info)
+    # 2) registerQuickRenewal, lancé pendant que BOMI est éventuellement encore en vol
+    # champs du panier en surcouche, sérialisés en une passe par pydantic-core
+    qr = flow.quickRenewal
+    overlay = {}
+    # model_copy ne valide pas : on convertit nous-mêmes vers les types du modèle
+    if first_amount is not None and qr.amount is None:
+        try:
+            overlay["amount"] = float(first_amount)
+        except (TypeError, ValueError):
+            log.warning("recharge: firstAmount non numérique ignoré: %r", first_amount)
+    if offer_code and not qr.offerCode:
+        overlay["offerCode"] = str(offer_code)
+    if duration and not qr.duration:
+        overlay["duration"] = str(duration)
+    quick_body = (qr.model_copy(update=overlay) if overlay else qr).model_dump_json()
+
+    reg_url = URL_REGISTER_QUICK_RENEWAL
+    reg_coro = auth.req("POST", reg_url, content=quick_body, headers=JSON_HEADERS)
+    if bomi_task:
+        r_reg, r_bomi = await asyncio.gather(reg_coro, bomi_task, return_exceptions=True)
+        if isinstance(r_reg, BaseException):
+            raise r_reg
+    else:
+        r_reg, r_bomi = await reg_coro, None
+
+    # 3) BOMI, pour le rapport uniquement
     bomi_json = None
-    if BOMI_BASE:
-        bomi_url = f"{BOMI_BASE}/api/v1/paymentMeans"
-        params = {
-            "countryId": COUNTRY_ID,
-            "managementAct": "RENEWAL_QUICK",
-            "saleDeviceId": SALE_DEVICE_ID,
-            "distributorId": DISTRIBUTOR_ID,
-        }
-        async with httpx.AsyncClient(timeout=DEFAULT_TIMEOUT) as client:
-            r_bomi = await client.get(bomi_url, params=params, headers=BASE_HEADERS)
+    if isinstance(r_bomi, Exception):
+        bomi_json = {"error": str(r_bomi)}
+    elif r_bomi is not None:
         try:
-            bomi_json = r_bomi.json()
+            bomi_json = orjson.loads(r_bomi.content)
         except Exception:
             bomi_json = {"raw": r_bomi.text}
 
-    # 3) registerQuickRenewal
-    quick = flow.quickRenewal.model_dump(mode="json")
-    quick.setdefault("amount", first_amount)
-    if offer_code and not quick.get("offerCode"):
-        quick["offerCode"] = offer_code
-    if duration and not quick.get("duration"):
-        quick["duration"] = str(duration)
-
-    reg_url = f"{API_BASE}/cgaOnlineSales/registerQuickRenewal"
-    r_reg = await auth.req("POST", reg_url, json=quick)
     try:
-        reg_json = r_reg.json()
+        reg_json = orjson.loads(r_reg.content)
     except Exception:
         reg_json = {"raw": r_reg.text}
 
     report_url = reg_json.get("reportUrl")
     absolute_report = _abs_report_url(report_url) if report_url else None
 
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=200 if r_reg.status_code == 200 else r_reg.status_code,
         content={
             "status": reg_json.get("severity"),
@@ -384,39 +802,59 @@ async def recharge_flow(flow: RechargeFlowRequest, api_key: str = Security(get_a
 
 # ---------- Téléchargement du PDF ----------
 @app.get("/report/download")
-async def report_download_get(reportUrl: Optional[str] = None, api_key: str = Security(get_api_key)):
+async def report_download_get(reportUrl: Optional[str] = None, api_key: str = API_KEY_DEP):
     if not reportUrl:
         raise HTTPException(400, "reportUrl manquant")
     return await _download_report(reportUrl)
 
 @app.post("/report/download")
-async def report_download_post(body: ReportDownloadRequest, api_key: str = Security(get_api_key)):
+async def report_download_post(body: ReportDownloadRequest, api_key: str = API_KEY_DEP):
     return await _download_report(body.reportUrl)
 
 async def _download_report(reportUrl: str):
-    if "reports/" not in reportUrl:
+    if not _REPORT_RE.match(reportUrl):
         raise HTTPException(400, "reportUrl invalide")
     url = _abs_report_url(reportUrl)
-    r = await auth.req("GET", url, headers={"Accept": "*/*"})
-    ctype = r.headers.get("Content-Type", "").lower()
-    fname = "recu.pdf"
-    cd = r.headers.get("Content-Disposition", "")
-    if "filename=" in cd:
-        fname = cd.split("filename=")[-1].strip('"; ')
-    if "application/pdf" in ctype or url.lower().endswith(".pdf"):
-        return StreamingResponse(
-            iter([r.content]),
-            media_type="application/pdf",
-            headers={"Content-Disposition": f'attachment; filename="{fname}"'},
-        )
+    r = await auth.stream("GET", url, headers={"Accept": "*/*"})
+    # un seul passage sur les en-têtes bruts (clés en casse d'origine en HTTP/1.1)
+    raw = {k.lower(): v for k, v in r.headers.raw}
+    ctype = raw.get(b"content-type", b"").lower()
+    m = _FN_RE.search(raw.get(b"content-disposition", b""))
+    fname = m.group(1).strip().decode("latin-1") if m else "recu.pdf"
+    if ctype.startswith(b"application/pdf") or url.lower().endswith(".pdf"):
+        media_type = "application/pdf"
+    else:
+        media_type = ctype.decode("latin-1") or "application/octet-stream"
+    headers = {"Content-Disposition": f'attachment; filename="{fname}"'}
+    # 64 Ko par morceau : la réponse upstream n'est jamais bufferisée en entier.
+    # Sans Content-Encoding, les octets bruts sont relayés tels quels (pas de décodeur httpx)
+    # et la taille upstream reste valable pour le client.
+    if raw.get(b"content-encoding", b"identity").lower() == b"identity":
+        chunks = r.aiter_raw(65536)
+        if b"content-length" in raw:
+            headers["Content-Length"] = raw[b"content-length"].decode("latin-1")
+    else:
+        chunks = r.aiter_bytes(65536)
     return StreamingResponse(
-        iter([r.content]),
-        media_type=ctype or "application/octet-stream",
-        headers={"Content-Disposition": f'attachment; filename="{fname}"'},
+        chunks,
+        media_type=media_type,
+        headers=headers,
+        background=BackgroundTask(r.aclose),
     )
 # ================== UVICORN (Railway) ==================
 if __name__ == "__main__":
     import uvicorn
 
     port = int(os.environ.get("PORT", "8000"))
-    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=False)
+    workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+    # uvloop + httptools sont fournis par uvicorn[standard] ; access log coupé (logs via "gateway")
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        reload=False,
+        loop="uvloop",
+        http="httptools",
+        workers=workers,
+        access_log=False,
+    )